@@ -6,10 +6,37 @@
 # XYZ format, and manage storing it.
 
 from argparse import ArgumentParser
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+import mmap
+import os
+import re
+import stat
 import sys
 from typing import *
 from typing import TextIO
 
+# Buffer size for the output files, to write them in large chunks
+BUFFER_SIZE = 1 << 20
+
+# Number of lines between a coordinates header and the first atom line
+# (an empty line, the column titles, and a line of dashes)
+_SKIP_LINES = 3
+
+# Headers that precede a geometry in the NWChem output
+_HDR_PREFIX = b"Output coordinates in "
+_HDR_ANG = b"Output coordinates in angstroms"
+_HDR_AU = b"Output coordinates in a.u."
+
+# An empty (or whitespace only) line terminates the list of atoms. The
+# character class is the whitespace that bytes.split() separates on
+# (besides the newline itself), so a line matches exactly when split()
+# would return no tokens for it
+_BLANK_LINE = re.compile(rb"^[ \t\r\f\v]*$",re.MULTILINE)
+
 def parse_args():
     """Parse the command line arguments"""
     parser = ArgumentParser(description="""
@@ -22,18 +49,67 @@ def parse_args():
                         help="prefix for output filenames")
     parser.add_argument("--separate",action="store_true",default=False,
                         help="write separate XYZ file for each geometry")
-    parser.add_argument("--together",action="store_true",default=True,
-                        help="write one XYZ file per NWChem output file")
+    parser.add_argument("--together",action="store_true",default=False,
+                        help="write one XYZ file per NWChem output file "
+                             "(the default if no other output is selected)")
     parser.add_argument("--alltogether",action="store_true",default=False,
                         help="write one XYZ file for all NWChem output files")
     args = parser.parse_args()
+    if not (args.separate or args.together or args.alltogether):
+        args.together = True
     return vars(args)
 
+@lru_cache(maxsize=None)
+def _atom_numbers(natoms: int) -> list[bytes]:
+    """Return the atom numbers 1..natoms as they appear in the output
+
+    The result is cached as the geometries from one output file typically
+    all have the same number of atoms. It must not be modified.
+    """
+    return [str(i).encode() for i in range(1,natoms+1)]
+
+def _parse_atoms(block: bytes, fac: float) -> tuple[list[str], array]:
+    """Parse a block of atom lines from an NWChem geometry
+
+    Every line holds the atom number, the tag, the charge, and the x, y,
+    and z coordinates. The symbols are returned together with a flat array
+    of the coordinates multiplied by "fac".
+    """
+    # Tokenize the whole atom block at once and convert the
+    # coordinate columns in bulk rather than line by line. The block is
+    # split as bytes, float() accepts bytes directly, so only the symbols
+    # are ever decoded to str
+    tokens = block.split()
+    natoms = block.count(b"\n")
+    if block and not block.endswith(b"\n"):
+        natoms += 1
+    # A matching total token count does not guarantee that every line has
+    # 6 tokens, so also check that the first column holds the atom numbers
+    # 1..natoms. Only if either check fails are the lines inspected one by one
+    if len(tokens) != 6*natoms or tokens[0::6] != _atom_numbers(natoms):
+        for line in block.splitlines():
+            if len(line.split()) != 6:
+                print("Invalid number of tokens for coordinates")
+                print(f"Line is: {line.decode()}")
+                sys.exit()
+    symbols = [symbol.decode() for symbol in tokens[1::6]]
+    # The number of atoms is known, so allocate the coordinates up front
+    # and fill in the x, y, and z columns with strided assignments. The
+    # unit conversion is applied as part of the same C-level map
+    xyz = array("d",[0.0])*(3*natoms)
+    for dim in range(3):
+        column = map(float,tokens[3+dim::6])
+        if fac != 1.0:
+            column = map(float(fac).__mul__,column)
+        xyz[dim::3] = array("d",column)
+    return symbols, xyz
+
 class Geometry:
     """A class to hold the NWChem geometry data
 
-    The main data piece of information is a list of lines with one atom
-    per line, e.g. "Li  1.0 2.0 3.0".
+    The main data pieces of information are the atoms, stored as a list
+    of chemical symbols, e.g. "Li", and an array of Cartesian coordinates
+    in Angstrom with three consecutive entries (x, y, z) per atom.
 
     Further meta-data can also be associated with the structure:
     - source:  the file the geometry was extracted from
@@ -42,13 +118,27 @@ class Geometry:
     - lattice: the lattice specification if the geometry came from a periodic calculation
     """
 
-    def __init__(self, source: str, count: int, units: str, fp: TextIO):
-        """Read the geometry from the current file position"""
+    def __init__(self, source: str, count: int, units: str):
+        """Create an empty geometry"""
         self.section: str = None
         self.lattice: str = None
-        self.coords: list[str] = []
+        self.symbols: list[str] = []
+        self.xyz: array = array("d")
+        self._formatted: Optional[str] = None
         self.source = source
         self.count = count
+        self.units = units
+
+    @classmethod
+    def from_buffer(cls, source: str, count: int, units: str,
+                    data: Union[bytes, mmap.mmap], start: int) -> tuple["Geometry", int]:
+        """Read the geometry from the contents of an output file
+
+        The atom lines start at offset "start" in "data" and run up to the
+        first empty line. The geometry is returned together with the offset
+        of that empty line.
+        """
+        geom = cls(source,count,units)
         if units == "au":
             fac = 1.0/1.889725989
         elif units == "angstrom":
@@ -58,22 +148,11 @@ class Geometry:
         else:
             print(f"Unknown units: {units}")
             sys.exit()
-        for line in fp:
-            tokens = line.split()
-            ntokens = len(tokens)
-            if ntokens == 0:
-                # Reached an empty line this is the end of the geometry
-                break
-            elif ntokens == 6:
-                xx = float(tokens[3])*fac
-                yy = float(tokens[4])*fac
-                zz = float(tokens[5])*fac
-                atom = f"{tokens[1]} {xx} {yy} {zz}"
-            else:
-                print("Invalid number of tokens for coordinates")
-                print(f"Line is: {line}")
-                sys.exit()
-            self.coords.append(atom)
+        # Find the empty line that terminates the geometry
+        match = _BLANK_LINE.search(data,start)
+        end = match.start() if match else len(data)
+        geom.symbols, geom.xyz = _parse_atoms(data[start:end],fac)
+        return geom, end
 
     def set_section(self, section: str):
         """Set the output file section"""
@@ -91,10 +170,10 @@ class Geometry:
         """Retrieve the structure count"""
         return self.count
 
-    def write(self, fp: TextIO):
-        """Write the structure to a file
+    def to_string(self) -> str:
+        """Return the structure in XYZ format as a single string
 
-        This function can write both the regular XYZ file format as
+        This function can produce both the regular XYZ file format as
         well as the extented XYZ format. The extended XYZ format
         is triggered by the lattice attribute being set.
 
@@ -103,68 +182,116 @@ class Geometry:
         The extended XYZ format is described, for example, in the
         Ovito documentation: https://www.ovito.org/docs/current/reference/file_formats/input/xyz.html#extended-xyz-format.
         """
-        natoms = len(self.coords)
+        natoms = len(self.symbols)
         comment = ""
         if self.lattice:
             # Write extended XYZ format
             comment += f"Lattice={self.lattice} Properties=species:S:1:pos:R:3"
-        fp.write(f"{natoms}\n")
-        fp.write(f"{comment}\n")
-        for atom in self.coords:
-            fp.write(f"{atom}\n")
+        # The atom lines do not change, format them only once in case
+        # the structure is written to more than one file
+        if self._formatted is None:
+            xyz = self.xyz
+            self._formatted = "".join(f"{symbol} {x} {y} {z}\n" for symbol, x, y, z in
+                                      zip(self.symbols,xyz[0::3],xyz[1::3],xyz[2::3]))
+        return f"{natoms}\n{comment}\n{self._formatted}"
 
-def run_extractor(files: list[str]) -> list[Geometry]:
+    def write(self, fp: TextIO):
+        """Write the structure to a file
+
+        See to_string for details on the format.
+        """
+        fp.write(self.to_string())
+
+def run_extractor(files: list[str]) -> Iterator[Geometry]:
     """Extract geometries from a list of outputfiles
 
-    The extracted geometries are returned in a list.
+    The extracted geometries are yielded one at a time. With more than one
+    output file the files are processed in parallel, the geometries are
+    yielded in the order of the files regardless. In that case a worker
+    returns all geometries of a file at once, and only about one file per
+    CPU is in flight so that memory stays bounded by a few files rather
+    than by all of them.
+    """
+    if len(files) > 1:
+        window = os.cpu_count() or 1
+        remaining = iter(files)
+        with ProcessPoolExecutor() as executor:
+            pending = deque(executor.submit(extract_geometries,file)
+                            for file in islice(remaining,window))
+            while pending:
+                file_geometries = pending.popleft().result()
+                # Keep the workers busy while the geometries are consumed
+                for file in islice(remaining,1):
+                    pending.append(executor.submit(extract_geometries,file))
+                yield from file_geometries
+    else:
+        for file in files:
+            yield from stream_geometries(file)
+
+def extract_geometries(file: str) -> list[Geometry]:
+    """Extract all geometries from a single output file into a list"""
+    return list(stream_geometries(file))
+
+def stream_geometries(file: str) -> Iterator[Geometry]:
+    """Extract all geometries from a single output file one at a time"""
+    with open(file,"rb") as fp:
+        # Pipes, such as process substitutions, and empty files cannot be
+        # memory mapped, read those into memory instead
+        status = os.fstat(fp.fileno())
+        if not stat.S_ISREG(status.st_mode) or status.st_size == 0:
+            yield from scan_geometries(file,fp.read())
+            return
+        # NWChem output files can be hundreds of MB, map them into
+        # memory instead of reading a copy of the whole file
+        with mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ) as data:
+            if hasattr(mmap,"MADV_SEQUENTIAL"):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            yield from scan_geometries(file,data)
+
+def scan_geometries(filename: str, data: Union[bytes, mmap.mmap]) -> Iterator[Geometry]:
+    """Go through a single output file and yield all geometries
+
+    The whole contents of the output file are passed in as "data", either
+    as bytes or as a memory mapped file. Rather than looking at every line,
+    the scanner jumps from one coordinates header to the next with find().
     """
-    geometries: list[Geometry] = []
-    for file in files:
-        with open(file) as fp:
-            geometries = append_geometries(geometries,file,fp)
-    return geometries
-
-def skip_lines(fp: TextIO, num: int) -> None:
-    """Skip a number of lines"""
-    while num > 0:
-        line = fp.readline()
-        num -= 1
-
-def append_geometries(geom_in: list[Geometry], filename: str, fp: TextIO) -> list[Geometry]:
-    """Go through a single output file and extract all geometries"""
     count = 0
-    for line in fp:
-       # Check if we're at a geometry
-       if line.strip().startswith("Output coordinates in angstroms"):
-          #DEBUG
-          print("angstroms")
-          #DEBUG
-          count += 1
-          units = "angstrom"
-          skip_lines(fp,3)
-          geom_in.append(Geometry(filename,count,units,fp))
-       elif line.strip().startswith("Output coordinates in a.u."):
-          #DEBUG
-          print("a.u.")
-          #DEBUG
-          count += 1
-          units = "au"
-          skip_lines(fp,3)
-          geom_in.append(Geometry(filename,count,units,fp))
-    return geom_in
+    pos = data.find(_HDR_PREFIX)
+    while pos >= 0:
+        # The header has to be the first text on its line
+        linestart = data.rfind(b"\n",0,pos) + 1
+        if data[linestart:pos].strip():
+            pos = data.find(_HDR_PREFIX,pos+len(_HDR_PREFIX))
+            continue
+        # Check which kind of geometry we're at
+        if data[pos:pos+len(_HDR_ANG)] == _HDR_ANG:
+            units = "angstrom"
+        elif data[pos:pos+len(_HDR_AU)] == _HDR_AU:
+            units = "au"
+        else:
+            pos = data.find(_HDR_PREFIX,pos+len(_HDR_PREFIX))
+            continue
+        count += 1
+        # Skip the header line itself and the lines that follow it
+        for _ in range(1 + _SKIP_LINES):
+            newline = data.find(b"\n",pos)
+            pos = len(data) if newline < 0 else newline + 1
+        geometry, pos = Geometry.from_buffer(filename,count,units,data,pos)
+        yield geometry
+        pos = data.find(_HDR_PREFIX,pos)
 
+@lru_cache(maxsize=None)
 def get_basename(filename: str) -> str:
     """Get the base name of a file
 
     The base name is defined as the name of a file without a path,
     and without an extension. E.g. the base name of "/share/structure.txt"
-    is "structure".
+    is "structure", and of "/share/water.opt.out" is "water.opt". The
+    result is cached as many geometries share the same source file.
     """
-    path = filename.split("/")
-    basename = path[-1].split(".")
-    return basename[0]
+    return os.path.splitext(os.path.basename(filename))[0]
 
-def write_separate(prefix: str, geometries: list[Geometry]) -> None:
+def write_separate(prefix: str, geometries: Iterable[Geometry]) -> None:
     """Write every geometry to a separate file
 
     The filename is constructed from the prefix, the NWChem output filename,
@@ -178,47 +305,51 @@ def write_separate(prefix: str, geometries: list[Geometry]) -> None:
         with open(filename,"w") as fp:
             geometry.write(fp)
 
-def write_together(prefix: str, geometries: list[Geometry]) -> None:
+def write_together(prefix: str, geometries: Iterable[Geometry]) -> None:
     """Write all geometries that came from the same output file to a single file
 
     The filename is constructed from the prefix, and the NWChem output filename.
+    Each file is kept open while consecutive geometries go to it. If a file
+    shows up again later it is appended to rather than overwritten.
     """
     oldfilename = ""
-    for geometry in geometries:
-        source = geometry.get_source()
-        number = geometry.get_count()
-        basename = get_basename(source)
-        filename = f"{prefix}{basename}.xyz"
-        if oldfilename == filename:
-            with open(filename,"a") as fp:
-                geometry.write(fp)
-        else:
-            oldfilename = filename
-            with open(filename,"w") as fp:
-                geometry.write(fp)
+    written: set[str] = set()
+    fp = None
+    try:
+        for geometry in geometries:
+            source = geometry.get_source()
+            basename = get_basename(source)
+            filename = f"{prefix}{basename}.xyz"
+            if oldfilename != filename:
+                if fp:
+                    fp.close()
+                oldfilename = filename
+                mode = "a" if filename in written else "w"
+                written.add(filename)
+                fp = open(filename,mode,buffering=BUFFER_SIZE)
+            geometry.write(fp)
+    finally:
+        if fp:
+            fp.close()
 
 
-def write_all_together(prefix: str, geometries: list[Geometry]) -> None:
+def write_all_together(prefix: str, geometries: Iterable[Geometry]) -> None:
     """Write all geometries a single file
 
     The filename is constructed from the prefix.
     """
     filename = f"{prefix}.xyz"
-    with open(filename,"w") as fp:
-        for geometry in geometries:
-           geometry.write(fp)
+    with open(filename,"w",buffering=BUFFER_SIZE) as fp:
+        fp.writelines(geometry.to_string() for geometry in geometries)
 
 if __name__ == "__main__":
     args = parse_args()
-    #DEBUG
-    print(args["nwofilenames"])
-    print(args["prefix"])
-    print(args["separate"])
-    print(args["together"])
-    print(args["alltogether"])
-    #DEBUG
     geometries = run_extractor(args["nwofilenames"])
     prefix = args["prefix"]
+    # The geometries are streamed, if they are written more than once
+    # they have to be kept around
+    if args["separate"] + args["together"] + args["alltogether"] > 1:
+        geometries = list(geometries)
     if args["separate"]:
         write_separate(prefix,geometries)
     if args["together"]:
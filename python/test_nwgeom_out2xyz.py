@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# vi:ts=4:et
+
+# Regression tests for nwgeom_out2xyz.py, run with
+# "python -m unittest" from this directory.
+
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+import nwgeom_out2xyz
+
+class ParseAtomsTest(unittest.TestCase):
+
+    def test_misaligned_lines_are_rejected(self):
+        """Lines with 7 and 5 tokens must not pass as two lines with 6"""
+        block = b"  1 O 8.0 1.0 2.0 3.0 4.0\n  2 H 1.0 0.1 0.2\n"
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            with self.assertRaises(SystemExit):
+                nwgeom_out2xyz._parse_atoms(block,1.0)
+        self.assertIn("Invalid number of tokens for coordinates",out.getvalue())
+
+class FromBufferTest(unittest.TestCase):
+
+    def test_form_feed_line_ends_geometry(self):
+        """A line with only a form feed or vertical tab is blank"""
+        for blank in (b"\f",b" \v "):
+            data = b"  1 H 1.0 0.0 0.0 0.5\n" + blank + b"\n trailing text\n"
+            geom, end = nwgeom_out2xyz.Geometry.from_buffer("x.out",1,"angstrom",data,0)
+            self.assertEqual(geom.symbols,["H"])
+            self.assertEqual(list(geom.xyz),[0.0,0.0,0.5])
+
+class StreamGeometriesTest(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(os,"mkfifo"),"needs named pipes")
+    def test_pipe_input(self):
+        """Input that cannot be memory mapped is read instead"""
+        data = (b" Output coordinates in angstroms (scale by 1.0)\n"
+                b" \n"
+                b"  No.  Tag  Charge  X  Y  Z\n"
+                b" ---- ---- ------ -- -- --\n"
+                b"    1 O  8.0  0.0  0.0  0.1\n"
+                b"    2 H  1.0  0.0  0.7 -0.4\n"
+                b" \n")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fifo = os.path.join(tmpdir,"run.out")
+            os.mkfifo(fifo)
+            def feed():
+                with open(fifo,"wb") as fp:
+                    fp.write(data)
+            writer = threading.Thread(target=feed)
+            writer.start()
+            geometries = list(nwgeom_out2xyz.stream_geometries(fifo))
+            writer.join()
+        self.assertEqual(len(geometries),1)
+        self.assertEqual(geometries[0].symbols,["O","H"])
+        self.assertEqual(list(geometries[0].xyz),[0.0,0.0,0.1,0.0,0.7,-0.4])
+
+if __name__ == "__main__":
+    unittest.main()